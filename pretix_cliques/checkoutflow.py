@@ -1,6 +1,7 @@
+import hmac
+
 from django import forms
 from django.contrib import messages
-from django.db.transaction import atomic
 from django.shortcuts import redirect
 from django.utils.functional import cached_property
 from django.utils.translation import pgettext_lazy, gettext_lazy as _
@@ -13,6 +14,17 @@ from pretix.presale.views.cart import cart_session
 from .models import Clique
 
 
+def get_clique(request, event, pk):
+    """
+    Returns the clique with the given ID or ``None``. The result is memoized on the request, since
+    the checkout step and the signal receivers look up the same clique several times per request.
+    """
+    cache = request.__dict__.setdefault('_clique_cache', {})
+    if (event.pk, pk) not in cache:
+        cache[event.pk, pk] = Clique.objects.filter(event=event, pk=pk).first()
+    return cache[event.pk, pk]
+
+
 class CliqueCreateForm(forms.Form):
     error_messages = {
         'duplicate_name': _(
@@ -48,7 +60,10 @@ class CliqueCreateForm(forms.Form):
                 code='required'
             )
 
-        if Clique.objects.filter(event=self.event, name=name).exclude(pk=(self.clique.pk if self.clique else 0)).exists():
+        qs = Clique.objects.filter(event=self.event, name=name)
+        if self.clique:
+            qs = qs.exclude(pk=self.clique.pk)
+        if qs.exists():
             raise forms.ValidationError(
                 self.error_messages['duplicate_name'],
                 code='duplicate_name'
@@ -95,13 +110,13 @@ class CliqueJoinForm(forms.Form):
             }, code='required')
 
         try:
-            clique = Clique.objects.get(event=self.event, name=name)
+            clique = Clique.objects.only('pk', 'name', 'password').get(event=self.event, name=name)
         except Clique.DoesNotExist:
             raise forms.ValidationError({
                 'name': self.error_messages['clique_not_found'],
             }, code='clique_not_found')
         else:
-            if clique.password != password:
+            if not hmac.compare_digest((clique.password or '').encode(), (password or '').encode()):
                 raise forms.ValidationError({
                     'password': self.error_messages['pw_mismatch'],
                 }, code='pw_mismatch')
@@ -117,7 +132,6 @@ class CliqueStep(CartMixin, TemplateFlowStep):
     icon = 'group'
     label = pgettext_lazy('checkoutflow', 'Clique')
 
-    @atomic
     def post(self, request):
         self.request = request
 
@@ -134,14 +148,12 @@ class CliqueStep(CartMixin, TemplateFlowStep):
                     event=self.event,
                 )
                 if self.cart_session.get('clique_create'):
-                    try:
-                        clique = Clique.objects.get(event=self.event, pk=self.cart_session['clique_create'])
-                    except Clique.DoesNotExist:
-                        pass
+                    clique = get_clique(request, self.event, self.cart_session['clique_create']) or clique
 
                 clique.name = self.create_form.cleaned_data['name']
                 clique.password = self.create_form.cleaned_data['password']
                 clique.save()
+                getattr(request, '_clique_cache', {}).pop((self.event.pk, clique.pk), None)
                 self.cart_session['clique_create'] = clique.pk
                 return redirect(self.get_next_url(request))
         elif self.cart_session['clique_mode'] == 'none':
@@ -150,18 +162,23 @@ class CliqueStep(CartMixin, TemplateFlowStep):
         messages.error(self.request, _("We couldn't handle your input, please check below for errors."))
         return self.render()
 
+    def _initial_for_create(self):
+        current = get_clique(self.request, self.event, self.cart_session['clique_create'])
+        if current is None:
+            return {}, None
+        return {'name': current.name, 'password': current.password}, current
+
+    def _initial_for_join(self):
+        clique = get_clique(self.request, self.event, self.cart_session['clique_join'])
+        if clique is None:
+            return {}
+        return {'name': clique.name, 'password': clique.password}
+
     @cached_property
     def create_form(self):
-        initial = {}
-        current = None
+        initial, current = {}, None
         if self.cart_session.get('clique_mode') == 'create' and 'clique_create' in self.cart_session:
-            try:
-                current = Clique.objects.get(event=self.event, pk=self.cart_session['clique_create'])
-            except Clique.DoesNotExist:
-                pass
-            else:
-                initial['name'] = current.name
-                initial['password'] = current.password
+            initial, current = self._initial_for_create()
 
         return CliqueCreateForm(
             event=self.event,
@@ -175,13 +192,7 @@ class CliqueStep(CartMixin, TemplateFlowStep):
     def join_form(self):
         initial = {}
         if self.cart_session.get('clique_mode') == 'join' and 'clique_join' in self.cart_session:
-            try:
-                clique = Clique.objects.get(event=self.event, pk=self.cart_session['clique_join'])
-            except Clique.DoesNotExist:
-                pass
-            else:
-                initial['name'] = clique.name
-                initial['password'] = clique.password
+            initial = self._initial_for_join()
 
         return CliqueJoinForm(
             event=self.event,
@@ -203,24 +214,30 @@ class CliqueStep(CartMixin, TemplateFlowStep):
         return ctx
 
     def is_completed(self, request, warn=False):
-        if request.event.has_subevents and cart_session(request).get('clique_mode') == 'join' and 'clique_join' in cart_session(request):
-            try:
-                clique = Clique.objects.get(event=self.event, pk=cart_session(request)['clique_join'])
-                clique_subevents = set(c['order__all_positions__subevent'] for c in clique.ordercliques.filter(order__all_positions__canceled=False).values('order__all_positions__subevent').distinct())
+        cs = cart_session(request)
+        if request.event.has_subevents and cs.get('clique_mode') == 'join' and 'clique_join' in cs:
+            clique = get_clique(request, self.event, cs['clique_join'])
+            if clique:
+                clique_subevents = set(clique.subevent_ids)
                 if clique_subevents:
-                    cart_subevents = set(c['subevent'] for c in get_cart(request).values('subevent').distinct())
-                    if any(c not in clique_subevents for c in cart_subevents):
+                    cart_subevents = {p.subevent_id for p in get_cart(request)}
+                    if not cart_subevents <= clique_subevents:
+                        # Bulk updates of positions bypass the signals keeping subevent_ids up to date,
+                        # so recompute it before turning the customer away
+                        clique.subevent_ids = Clique.update_subevent_ids(clique.pk)
+                        clique_subevents = set(clique.subevent_ids)
+                    if clique_subevents and not cart_subevents <= clique_subevents:
                         if warn:
+                            first_clique_se = next(iter(clique_subevents))
+                            first_cart_se = next(iter(cart_subevents))
+                            subevents = SubEvent.objects.filter(pk__in={first_clique_se, first_cart_se}).in_bulk()
                             messages.warning(request, _('You requested to join a clique that participates in "{subevent_clique}", while you chose to participate in "{subevent_cart}". Please choose a different clique.').format(
-                                subevent_clique=SubEvent.objects.get(pk=list(clique_subevents)[0]).name,
-                                subevent_cart=SubEvent.objects.get(pk=list(cart_subevents)[0]).name,
+                                subevent_clique=subevents[first_clique_se].name,
+                                subevent_cart=subevents[first_cart_se].name,
                             ))
                         return False
-            except Clique.DoesNotExist:
-                pass
-
 
-        return 'clique_mode' in cart_session(request)
+        return 'clique_mode' in cs
 
     def is_applicable(self, request):
         return True
@@ -0,0 +1,31 @@
+from django.db import migrations, models
+
+
+def populate_subevent_ids(apps, schema_editor):
+    Clique = apps.get_model('pretix_cliques', 'Clique')
+    OrderClique = apps.get_model('pretix_cliques', 'OrderClique')
+    for clique in Clique.objects.iterator():
+        clique.subevent_ids = sorted(
+            OrderClique.objects.filter(
+                clique=clique,
+                order__all_positions__canceled=False,
+                order__all_positions__subevent__isnull=False,
+            ).values_list('order__all_positions__subevent', flat=True).distinct()
+        )
+        clique.save(update_fields=['subevent_ids'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pretix_cliques', '0003_orderraffleoverride'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='clique',
+            name='subevent_ids',
+            field=models.JSONField(default=list),
+        ),
+        migrations.RunPython(populate_subevent_ids, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,36 @@
+from django.db import migrations, models
+
+MODES = {
+    'always': 1,
+    'never': 2,
+    'chance': 3,
+}
+
+
+def forwards(apps, schema_editor):
+    OrderRaffleOverride = apps.get_model('pretix_cliques', 'OrderRaffleOverride')
+    for old, new in MODES.items():
+        OrderRaffleOverride.objects.filter(mode=old).update(mode=str(new))
+    OrderRaffleOverride.objects.exclude(mode__in=[str(v) for v in MODES.values()]).update(mode=str(MODES['chance']))
+
+
+def backwards(apps, schema_editor):
+    OrderRaffleOverride = apps.get_model('pretix_cliques', 'OrderRaffleOverride')
+    for old, new in MODES.items():
+        OrderRaffleOverride.objects.filter(mode=str(new)).update(mode=old)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pretix_cliques', '0005_clique_subevent_ids'),
+    ]
+
+    operations = [
+        migrations.RunPython(forwards, backwards),
+        migrations.AlterField(
+            model_name='orderraffleoverride',
+            name='mode',
+            field=models.PositiveSmallIntegerField(choices=[(1, 'always chosen'), (2, 'never chosen'), (3, 'normal chance')], default=3),
+        ),
+    ]
@@ -0,0 +1,25 @@
+from django.db import migrations, models
+
+
+def populate_name_normalized(apps, schema_editor):
+    Clique = apps.get_model('pretix_cliques', 'Clique')
+    for clique in Clique.objects.iterator():
+        clique.name_normalized = clique.name.casefold()
+        clique.save(update_fields=['name_normalized'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pretix_cliques', '0006_orderraffleoverride_mode_int'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='clique',
+            name='name_normalized',
+            field=models.TextField(db_index=True, default='', editable=False),
+            preserve_default=False,
+        ),
+        migrations.RunPython(populate_name_normalized, migrations.RunPython.noop),
+    ]
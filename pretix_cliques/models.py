@@ -1,13 +1,32 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+
 from django.db import models
 from django.utils.translation import gettext_lazy as _
 from pretix.base.models import LoggedModel
 
+_subevent_ids_suspended = ContextVar('pretix_cliques_subevent_ids_suspended', default=False)
+
+
+@contextmanager
+def subevent_ids_suspended():
+    """
+    Skips recomputing ``Clique.subevent_ids`` within the block, e.g. while deleting a whole clique.
+    """
+    token = _subevent_ids_suspended.set(True)
+    try:
+        yield
+    finally:
+        _subevent_ids_suspended.reset(token)
+
 
 class Clique(LoggedModel):
     event = models.ForeignKey('pretixbase.Event', on_delete=models.CASCADE, related_name='cliques')
     name = models.CharField(max_length=190)
+    name_normalized = models.TextField(db_index=True, editable=False)
     password = models.CharField(max_length=190, blank=True)
     created = models.DateTimeField(auto_now_add=True)
+    subevent_ids = models.JSONField(default=list)
 
     class Meta:
         unique_together = (('event', 'name'),)
@@ -16,6 +35,36 @@ class Clique(LoggedModel):
     def __str__(self):
         return self.name
 
+    def save(self, *args, **kwargs):
+        if not self._state.adding and kwargs.get('update_fields') is None:
+            # subevent_ids is only written by update_subevent_ids(), saving the instance must not
+            # overwrite a recomputation that happened after it was loaded
+            kwargs['update_fields'] = [
+                f.name for f in self._meta.concrete_fields if not f.primary_key and f.name != 'subevent_ids'
+            ]
+        self.name_normalized = self.name.casefold()
+        if kwargs.get('update_fields') and 'name' in kwargs['update_fields']:
+            kwargs['update_fields'] = {'name_normalized'}.union(kwargs['update_fields'])
+        super().save(*args, **kwargs)
+
+    @classmethod
+    def update_subevent_ids(cls, clique_id):
+        """
+        Recomputes the denormalized list of subevents that non-canceled tickets of the clique's
+        orders are for and returns it. ``clique_id`` may refer to a clique that no longer exists.
+        """
+        if _subevent_ids_suspended.get():
+            return None
+        subevent_ids = sorted(
+            OrderClique.objects.filter(
+                clique_id=clique_id,
+                order__all_positions__canceled=False,
+                order__all_positions__subevent__isnull=False,
+            ).values_list('order__all_positions__subevent', flat=True).distinct()
+        )
+        cls.objects.filter(pk=clique_id).update(subevent_ids=subevent_ids)
+        return subevent_ids
+
 
 class OrderClique(models.Model):
     order = models.OneToOneField('pretixbase.Order', related_name='orderclique', on_delete=models.CASCADE)
@@ -25,14 +74,15 @@ class OrderClique(models.Model):
 
 
 class OrderRaffleOverride(models.Model):
-    MODE_ALWAYS = 'always'
-    MODE_NEVER = 'never'
-    MODE_NORMAL = 'chance'
-    MODE_CHOICES = (
-        (MODE_ALWAYS, _('always chosen')),
-        (MODE_NEVER, _('never chosen')),
-        (MODE_NORMAL, _('normal chance'))
-    )
+    class Mode(models.IntegerChoices):
+        ALWAYS = 1, _('always chosen')
+        NEVER = 2, _('never chosen')
+        NORMAL = 3, _('normal chance')
+
+    MODE_ALWAYS = Mode.ALWAYS
+    MODE_NEVER = Mode.NEVER
+    MODE_NORMAL = Mode.NORMAL
+    MODE_CHOICES = Mode.choices
 
     order = models.OneToOneField('pretixbase.Order', related_name='raffle_override', on_delete=models.CASCADE)
-    mode = models.CharField(max_length=180, choices=MODE_CHOICES)
+    mode = models.PositiveSmallIntegerField(choices=MODE_CHOICES, default=MODE_NORMAL)
@@ -1,9 +1,14 @@
+from functools import lru_cache
+from types import MappingProxyType
+
 from django import forms
+from django.conf import settings
+from django.db.models.signals import post_delete, post_init, post_save
 from django.dispatch import receiver
 from django.http import HttpRequest
 from django.template.loader import get_template
-from django.urls import resolve, reverse
-from django.utils.translation import gettext_lazy as _
+from django.urls import reverse
+from django.utils.translation import get_language, gettext, gettext_lazy as _, gettext_noop
 from pretix.base.models import Event, Order, OrderPosition
 from pretix.base.signals import logentry_display, order_placed
 from pretix.control.forms.filter import FilterForm
@@ -14,8 +19,20 @@ from pretix.presale.signals import (
 )
 from pretix.presale.views.cart import cart_session
 
-from .checkoutflow import CliqueStep
-from .models import Clique, OrderClique
+from .checkoutflow import CliqueStep, get_clique
+from .models import Clique, OrderClique, OrderRaffleOverride
+
+
+@lru_cache(maxsize=None)
+def _cached_template(name):
+    return get_template(name)
+
+
+def _template(name):
+    # Skip the cache in development so template changes are picked up without a restart
+    if settings.DEBUG:
+        return get_template(name)
+    return _cached_template(name)
 
 
 @receiver(signal=checkout_flow_steps, dispatch_uid="clique_checkout_step")
@@ -36,46 +53,122 @@ def order_meta_signal(sender: Event, request: HttpRequest, **kwargs):
 @receiver(order_placed, dispatch_uid="clique_order_placed")
 def placed_order(sender: Event, order: Order, **kwargs):
     if order.meta_info_data and order.meta_info_data.get('clique_mode') == 'create':
-        try:
-            c = sender.cliques.get(pk=order.meta_info_data['clique_create'])
-        except Clique.DoesNotExist:
+        c = sender.cliques.filter(pk=order.meta_info_data['clique_create']).only('pk').first()
+        if c is None:
             return
-        else:
-            c.ordercliques.create(order=order, is_admin=True)
+        c.ordercliques.create(order=order, is_admin=True)
     elif order.meta_info_data and order.meta_info_data.get('clique_mode') == 'join':
-        try:
-            c = sender.cliques.get(pk=order.meta_info_data['clique_join'])
-        except Clique.DoesNotExist:
+        c = sender.cliques.filter(pk=order.meta_info_data['clique_join']).only('pk').first()
+        if c is None:
             return
-        else:
-            c.ordercliques.create(order=order, is_admin=False)
+        c.ordercliques.create(order=order, is_admin=False)
+
+
+@receiver(post_init, sender=OrderClique, dispatch_uid="clique_orderclique_init")
+def orderclique_post_init(sender, instance: OrderClique, **kwargs):
+    # Remember the loaded clique, since an order can be moved to a different one in the backend. The
+    # field might be deferred, in which case reading it here would cause a query.
+    if 'clique_id' in instance.__dict__:
+        instance._previous_clique_id = instance.clique_id
+
+
+@receiver(post_save, sender=OrderClique, dispatch_uid="clique_orderclique_saved")
+@receiver(post_delete, sender=OrderClique, dispatch_uid="clique_orderclique_deleted")
+def orderclique_changed(sender, instance: OrderClique, **kwargs):
+    update_fields = kwargs.get('update_fields')
+    if update_fields and not {'clique', 'clique_id'}.intersection(update_fields):
+        return
+    Clique.update_subevent_ids(instance.clique_id)
+    previous_clique_id = getattr(instance, '_previous_clique_id', None)
+    if previous_clique_id and previous_clique_id != instance.clique_id:
+        Clique.update_subevent_ids(previous_clique_id)
+    instance._previous_clique_id = instance.clique_id
+
+
+def _plugin_inactive(position: OrderPosition):
+    # Only decided without a query if pretix already loaded the order and its event, which it does
+    # when saving positions. Otherwise we fall back to looking up the clique.
+    if OrderPosition.order.is_cached(position) and Order.event.is_cached(position.order):
+        return 'pretix_cliques' not in position.order.event.get_plugins()
+    return False
+
+
+@receiver(post_init, sender=OrderPosition, dispatch_uid="clique_position_init")
+def position_post_init(sender, instance: OrderPosition, **kwargs):
+    # Remember the loaded order, since positions are moved to a new order when pretix splits an order
+    if 'order_id' in instance.__dict__:
+        instance._previous_order_id = instance.order_id
+
+
+@receiver(post_save, sender=OrderPosition, dispatch_uid="clique_position_saved")
+@receiver(post_delete, sender=OrderPosition, dispatch_uid="clique_position_deleted")
+def position_changed(sender, instance: OrderPosition, **kwargs):
+    update_fields = kwargs.get('update_fields')
+    if update_fields and not {'subevent', 'subevent_id', 'canceled', 'order', 'order_id'}.intersection(update_fields):
+        return
+    previous_order_id = getattr(instance, '_previous_order_id', None)
+    instance._previous_order_id = instance.order_id
+    if _plugin_inactive(instance):
+        return
+    order_ids = {instance.order_id, previous_order_id} - {None}
+    for clique_id in set(OrderClique.objects.filter(order_id__in=order_ids).values_list('clique_id', flat=True)):
+        Clique.update_subevent_ids(clique_id)
 
 
 @receiver(checkout_confirm_page_content, dispatch_uid="clique_confirm")
 def confirm_page(sender: Event, request: HttpRequest, **kwargs):
     cs = cart_session(request)
 
-    template = get_template('pretix_cliques/checkout_confirm.html')
+    template = _template('pretix_cliques/checkout_confirm.html')
     ctx = {
         'mode': cs.get('clique_mode'),
         'request': request,
     }
     if cs.get('clique_mode') == 'join':
-        try:
-            ctx['clique'] = sender.cliques.get(pk=cs.get('clique_join'))
-        except Clique.DoesNotExist:
+        ctx['clique'] = get_clique(request, sender, cs.get('clique_join'))
+        if ctx['clique'] is None:
             return
     elif cs.get('clique_mode') == 'create':
-        try:
-            ctx['clique'] = sender.cliques.get(pk=cs.get('clique_create'))
-        except Clique.DoesNotExist:
+        ctx['clique'] = get_clique(request, sender, cs.get('clique_create'))
+        if ctx['clique'] is None:
             return
     return template.render(ctx)
 
 
+def _get_orderclique(order):
+    """
+    Returns the ``OrderClique`` of an order together with its clique, or ``None``. If the caller
+    already loaded the relation, e.g. through ``select_related('orderclique__clique')``, no query
+    is made.
+    """
+    if Order.orderclique.is_cached(order):
+        return getattr(order, 'orderclique', None)
+    return OrderClique.objects.select_related('clique').filter(order=order).first()
+
+
+def _get_fellows(request, order, clique_id):
+    """
+    Returns the admission tickets of the other orders in the clique. The result is memoized on the
+    request if one is given.
+    """
+    cache = request.__dict__.setdefault('_cliques_fellows_cache', {}) if request else {}
+    if (clique_id, order.pk) not in cache:
+        fellows = list(OrderPosition.objects.filter(
+            order__status__in=(Order.STATUS_PENDING, Order.STATUS_PAID),
+            order__orderclique__clique_id=clique_id,
+            item__admission=True
+        ).exclude(order=order).select_related('order').only(
+            'id', 'attendee_name_cached', 'attendee_name_parts', 'order__id', 'order__event',
+        ))
+        for p in fellows:
+            p.order.event = order.event
+        cache[clique_id, order.pk] = fellows
+    return cache[clique_id, order.pk]
+
+
 @receiver(order_info, dispatch_uid="clique_order_info")
 def order_info(sender: Event, order: Order, **kwargs):
-    template = get_template('pretix_cliques/order_info.html')
+    template = _template('pretix_cliques/order_info.html')
 
     if not order.require_approval:
         return ""
@@ -84,81 +177,91 @@ def order_info(sender: Event, order: Order, **kwargs):
         'order': order,
         'event': sender,
     }
-    try:
-        c = order.orderclique
+    c = _get_orderclique(order)
+    if c:
         ctx['clique'] = c.clique
         ctx['is_admin'] = c.is_admin
-        ctx['fellows'] = OrderPosition.objects.filter(
-            order__status__in=(Order.STATUS_PENDING, Order.STATUS_PAID),
-            order__orderclique__clique=c.clique,
-            item__admission=True
-        ).exclude(order=order)
-    except OrderClique.DoesNotExist:
-        pass
+        if c.is_admin:
+            ctx['fellows'] = _get_fellows(kwargs.get('request'), order, c.clique_id)
 
     return template.render(ctx)
 
 
 @receiver(control_order_info, dispatch_uid="clique_control_order_info")
 def control_order_info(sender: Event, request, order: Order, **kwargs):
-    template = get_template('pretix_cliques/control_order_info.html')
+    template = _template('pretix_cliques/control_order_info.html')
 
     ctx = {
         'order': order,
         'event': sender,
         'request': request,
+        'raffle_modes': OrderRaffleOverride.Mode,
     }
-    try:
-        c = order.orderclique
+    c = _get_orderclique(order)
+    if c:
         ctx['clique'] = c.clique
         ctx['is_admin'] = c.is_admin
-    except OrderClique.DoesNotExist:
-        pass
 
     return template.render(ctx, request=request)
 
 
+_LOGENTRY_PLAINS = MappingProxyType({
+    'pretix_cliques.order.left': gettext_noop('The user left a clique.'),
+    'pretix_cliques.order.joined': gettext_noop('The user joined a clique.'),
+    'pretix_cliques.order.created': gettext_noop('The user created a new clique.'),
+    'pretix_cliques.order.changed': gettext_noop('The user changed a clique password.'),
+    'pretix_cliques.order.deleted': gettext_noop('The clique has been deleted.'),
+    'pretix_cliques.clique.deleted': gettext_noop('The clique has been changed.'),
+    'pretix_cliques.clique.changed': gettext_noop('The clique has been deleted.'),
+})
+
+
+@lru_cache(maxsize=128)
+def _logentry_text(action_type, language):
+    # language is only part of the cache key, gettext() uses the currently active language
+    return gettext(_LOGENTRY_PLAINS[action_type])
+
+
 @receiver(signal=logentry_display, dispatch_uid="clique_logentry_display")
 def shipping_logentry_display(sender, logentry, **kwargs):
-    if not logentry.action_type.startswith('pretix_cliques'):
-        return
+    if logentry.action_type in _LOGENTRY_PLAINS:
+        return _logentry_text(logentry.action_type, get_language())
 
-    plains = {
-        'pretix_cliques.order.left': _('The user left a clique.'),
-        'pretix_cliques.order.joined': _('The user joined a clique.'),
-        'pretix_cliques.order.created': _('The user created a new clique.'),
-        'pretix_cliques.order.changed': _('The user changed a clique password.'),
-        'pretix_cliques.order.deleted': _('The clique has been deleted.'),
-        'pretix_cliques.clique.deleted': _('The clique has been changed.'),
-        'pretix_cliques.clique.changed': _('The clique has been deleted.'),
-    }
 
-    if logentry.action_type in plains:
-        return plains[logentry.action_type]
+@lru_cache(maxsize=256)
+def _nav_urls(organizer_slug, event_slug):
+    kwargs = {
+        'event': event_slug,
+        'organizer': organizer_slug,
+    }
+    return (
+        reverse('plugins:pretix_cliques:event.cliques.list', kwargs=kwargs),
+        reverse('plugins:pretix_cliques:event.raffle', kwargs=kwargs),
+    )
 
 
 @receiver(nav_event, dispatch_uid="clique_nav")
 def control_nav_event(sender, request=None, **kwargs):
-    url = resolve(request.path_info)
-    if not request.user.has_event_permission(request.organizer, request.event, 'can_view_orders', request=request):
+    if not hasattr(request, '_cliques_can_view_orders'):
+        request._cliques_can_view_orders = request.user.has_event_permission(
+            request.organizer, request.event, 'can_view_orders', request=request
+        )
+    if not request._cliques_can_view_orders:
         return []
+    url = request.resolver_match
+    is_plugin = bool(url and url.namespace == 'plugins:pretix_cliques')
+    cliques_url, raffle_url = _nav_urls(request.event.organizer.slug, request.event.slug)
     return [
         {
             'label': _('Cliques'),
-            'url': reverse('plugins:pretix_cliques:event.cliques.list', kwargs={
-                'event': request.event.slug,
-                'organizer': request.event.organizer.slug,
-            }),
-            'active': (url.namespace == 'plugins:pretix_cliques' and 'cliques' in url.url_name),
+            'url': cliques_url,
+            'active': is_plugin and 'cliques' in url.url_name,
             'icon': 'group',
         },
         {
             'label': _('Raffle'),
-            'url': reverse('plugins:pretix_cliques:event.raffle', kwargs={
-                'event': request.event.slug,
-                'organizer': request.event.organizer.slug,
-            }),
-            'active': (url.namespace == 'plugins:pretix_cliques' and ('raffle' in url.url_name or 'stats' in url.url_name)),
+            'url': raffle_url,
+            'active': is_plugin and ('raffle' in url.url_name or 'stats' in url.url_name),
             'icon': 'bullseye',
         }
     ]
@@ -180,7 +283,7 @@ class CliqueSearchForm(FilterForm):
         fdata = self.cleaned_data
         qs = super().filter_qs(qs)
         if fdata.get('clique_name'):
-            qs = qs.filter(orderclique__clique__name__iexact=fdata.get('clique_name'))
+            qs = qs.filter(orderclique__clique__name_normalized=fdata.get('clique_name').casefold())
         return qs
 
 
@@ -1,19 +1,24 @@
-from collections import defaultdict
-
-from django.db.models import OuterRef, Count, Subquery, IntegerField
+from django.db.models import Case, F, OuterRef, Count, Max, Q, Subquery, Sum, IntegerField, Value, When
+from django.db.models.functions import Coalesce
 from pretix_cliques.models import OrderRaffleOverride
 
-from pretix.base.models import SubEvent, Order, Event, OrderPosition, User
+from pretix.base.models import SubEvent, LogEntry, Order, Event, OrderPosition, User
 from pretix.base.services.orders import approve_order, OrderError, deny_order
 from pretix.base.services.tasks import EventTask
 from pretix.celery_app import app
 import random
 
+ORDER_CHUNK_SIZE = 200
+
+
+def _orders_in_chunks(event, order_ids):
+    for i in range(0, len(order_ids), ORDER_CHUNK_SIZE):
+        yield from event.orders.filter(pk__in=order_ids[i:i + ORDER_CHUNK_SIZE]).prefetch_related('positions')
+
 
 @app.task(bind=True, base=EventTask)
 def run_raffle(self, event: Event, subevent_id: int, user_id: int, raffle_size: int, max_addons: int):
     subevent = SubEvent.objects.get(pk=subevent_id) if subevent_id else None
-    user = User.objects.get(pk=user_id)
 
     other_subevent_count = OrderPosition.objects.filter(
         order=OuterRef('pk'),
@@ -40,58 +45,56 @@ def run_raffle(self, event: Event, subevent_id: int, user_id: int, raffle_size:
         pcnt_othersub=Subquery(other_subevent_count, output_field=IntegerField()),
         pcnt_subevent=Subquery(subevent_count, output_field=IntegerField()),
         acnt_subevent=Subquery(addon_subevent_count, output_field=IntegerField()),
+        rom=F('raffle_override__mode'),
     ).filter(
         pcnt_othersub__isnull=True,
         pcnt_subevent__gte=1,
         require_approval=True,
         status=Order.STATUS_PENDING,
-    ).select_related('raffle_override', 'orderclique', 'orderclique__clique').prefetch_related('positions')
+    )
 
-    clique_ids_remove = set()
-    raffle_keys_prefer = set()
-    raffle_tickets = defaultdict(list)
+    # One row per raffle ticket, i.e. per clique or per order that is not part of a clique
+    raffle_ticket_rows = eligible_orders.annotate(
+        clique_key=F('orderclique__clique_id'),
+        order_key=Case(When(orderclique__isnull=True, then=F('pk'))),
+    ).order_by().values('clique_key', 'order_key').annotate(
+        n_tickets=Coalesce(Sum('pcnt_subevent'), 0),
+        n_addons=Coalesce(Sum('acnt_subevent'), 0),
+        has_always=Max(Case(When(rom=OrderRaffleOverride.MODE_ALWAYS, then=Value(1)), default=Value(0))),
+        has_never=Max(Case(When(rom=OrderRaffleOverride.MODE_NEVER, then=Value(1)), default=Value(0))),
+    )
 
-    for order in eligible_orders:
-        try:
-            rom = order.raffle_override.mode
-        except OrderRaffleOverride.DoesNotExist:
-            rom = None
+    raffle_keys_prefer = []
+    raffle_keys_not_preferred = []
+    raffle_tickets = {}
 
-        if rom == OrderRaffleOverride.MODE_NEVER:
+    for r in raffle_ticket_rows:
+        if r['has_never']:
             # banned ticket, ban whole clique
-            if getattr(order, 'orderclique', None):
-                clique_ids_remove.add(order.orderclique.clique_id)
             continue
 
-        if getattr(order, 'orderclique', None):
-            raffle_tickets['clique', order.orderclique.clique_id].append(order)
-            if rom == OrderRaffleOverride.MODE_ALWAYS:
-                raffle_keys_prefer.add(('clique', order.orderclique.clique_id))
+        key = ('clique', r['clique_key']) if r['clique_key'] else ('order', r['order_key'])
+        raffle_tickets[key] = r
+        if r['has_always']:
+            raffle_keys_prefer.append(key)
         else:
-            raffle_tickets['order', order.code].append(order)
-            if rom == OrderRaffleOverride.MODE_ALWAYS:
-                raffle_keys_prefer.add(('order', order.code))
-
-    for k in clique_ids_remove:
-        try:
-            del raffle_tickets['clique', k]
-            raffle_keys_prefer.remove(('clique', k))
-        except KeyError:
-            pass
-
-    raffle_keys_not_preferred = [k for k in raffle_tickets.keys() if k not in raffle_keys_prefer]
+            raffle_keys_not_preferred.append(key)
+
     random.shuffle(raffle_keys_not_preferred)
 
-    raffle_order = list(raffle_keys_prefer) + raffle_keys_not_preferred
+    raffle_order = raffle_keys_prefer + raffle_keys_not_preferred
     approvals_left = raffle_size
     addons_left = max_addons
 
-    orders_to_approve = []
+    winning_clique_ids = []
+    winning_order_ids = []
+
+    for key in raffle_order:
+        if approvals_left <= 0:
+            break
 
-    while raffle_order and approvals_left > 0:
-        orders = raffle_tickets[raffle_order.pop(0)]
-        n_tickets = sum(o.pcnt_subevent for o in orders)
-        n_addons = sum(o.acnt_subevent for o in orders)
+        n_tickets = raffle_tickets[key]['n_tickets']
+        n_addons = raffle_tickets[key]['n_addons']
 
         if n_addons > addons_left:
             # We do not have enough add-ons left to service this raffle ticket, skip to the
@@ -101,30 +104,52 @@ def run_raffle(self, event: Event, subevent_id: int, user_id: int, raffle_size:
         # We do not skip if n_tickets < approvals_left, so we prefer giving out a few more
         # tickets than planned over a few less. This is intentional / accepted behaviour.
 
-        orders_to_approve += orders
+        if key[0] == 'clique':
+            winning_clique_ids.append(key[1])
+        else:
+            winning_order_ids.append(key[1])
         approvals_left -= n_tickets
         addons_left -= n_addons
 
+    order_ids = list(eligible_orders.filter(
+        Q(orderclique__clique_id__in=winning_clique_ids) | Q(pk__in=winning_order_ids)
+    ).order_by().values_list('pk', flat=True))
+
+    # Every order still goes through approve_order, since approving an order has side effects
+    # (transactions, invoices, emails, plugin signals) that we can not replicate with a bulk update.
+    # The orders are loaded chunk by chunk to keep memory usage bounded.
+    user = User.objects.get(pk=user_id)
     self.update_state(
         state='PROGRESS',
         meta={'value': 0}
     )
-    for i, order in enumerate(orders_to_approve):
-        try:
-            approve_order(
-                order,
-                user=user,
-                send_mail=True,
-            )
-        except OrderError as e:
-            order.log_action('pretix_cliques.raffle.approve_failed', data={'detail': str(e)}, user=user)
-        if i % 50 == 0:
-            self.update_state(
-                state='PROGRESS',
-                meta={'value': round(i / len(orders_to_approve) * 100, 2)}
-            )
-
-    return len(orders_to_approve)
+    total = len(order_ids)
+    progress_step = max(50, total // 100)
+    approved = 0
+    logs = []
+    try:
+        for i, order in enumerate(_orders_in_chunks(event, order_ids)):
+            try:
+                approve_order(
+                    order,
+                    user=user,
+                    send_mail=True,
+                )
+            except OrderError as e:
+                logs.append(order.log_action('pretix_cliques.raffle.approve_failed', data={'detail': str(e)}, user=user,
+                                             save=False))
+            else:
+                approved += 1
+            if i % progress_step == 0:
+                self.update_state(
+                    state='PROGRESS',
+                    meta={'value': (i * 100) // total}
+                )
+    finally:
+        # Keep the failure logs of the orders handled so far, even if an unexpected error aborts the raffle
+        LogEntry.objects.bulk_create(logs, batch_size=500)
+
+    return approved
 
 
 @app.task(bind=True, base=EventTask)
@@ -136,27 +161,30 @@ def run_rejection(self, event: Event, subevent_id: int, user_id: int):
         subevent_id=subevent_id,
         item__admission=True
     ).order_by().values('order').annotate(k=Count('id')).values('k')
-    orders = list(event.orders.annotate(
+    # Only load the IDs up front and fetch the orders chunk by chunk to keep memory usage bounded
+    order_ids = list(event.orders.annotate(
         pcnt_subevent=Subquery(subevent_count, output_field=IntegerField()),
     ).filter(
         pcnt_subevent__gte=1,
         require_approval=True,
         status=Order.STATUS_PENDING,
-    ))
+    ).order_by().values_list('pk', flat=True))
     self.update_state(
         state='PROGRESS',
         meta={'value': 0}
     )
-    for i, order in enumerate(orders):
+    total = len(order_ids)
+    progress_step = max(50, total // 100)
+    for i, order in enumerate(_orders_in_chunks(event, order_ids)):
         deny_order(
             order,
             user=user,
             send_mail=True,
         )
-        if i % 50 == 0:
+        if i % progress_step == 0:
             self.update_state(
                 state='PROGRESS',
-                meta={'value': round(i / len(orders) * 100, 2)}
+                meta={'value': (i * 100) // total}
             )
 
-    return len(orders)
+    return total
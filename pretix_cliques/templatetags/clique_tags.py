@@ -9,6 +9,14 @@ def sum_filter(value):
         return 0
 
     if isinstance(value, dict):
-        return sum([sum_filter(v) if isinstance(v, dict) else v for v in value.values()])
+        total = 0
+        stack = [value]
+        while stack:
+            for v in stack.pop().values():
+                if isinstance(v, dict):
+                    stack.append(v)
+                else:
+                    total += v
+        return total
 
     return sum(value)
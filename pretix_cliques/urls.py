@@ -1,7 +1,7 @@
 from django.urls import path, re_path
 
 from .views import (
-    CliqueDelete, CliqueDetail, CliqueList, ControlCliqueChange, MetricsView,
+    CliqueDelete, CliqueDetail, CliqueList, CliqueSelect2, ControlCliqueChange, MetricsView,
     OrderCliqueChange, RaffleOverrideChange, RaffleView, RaffleRejectView, StatsView
 )
 
@@ -20,6 +20,8 @@ urlpatterns = [
          RaffleRejectView.as_view(), name='event.raffle.reject'),
     path('control/event/<str:organizer>/<str:event>/cliques/',
          CliqueList.as_view(), name='event.cliques.list'),
+    path('control/event/<str:organizer>/<str:event>/cliques/select2',
+         CliqueSelect2.as_view(), name='event.cliques.select2'),
     path('control/event/<str:organizer>/<str:event>/cliques/<int:pk>/',
          CliqueDetail.as_view(), name='event.cliques.detail'),
     path('control/event/<str:organizer>/<str:event>/cliques/<int:pk>/delete',
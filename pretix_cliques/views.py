@@ -1,12 +1,12 @@
 import base64
 import hmac
-from collections import defaultdict
+from functools import lru_cache
 
 from django import forms
 from django.contrib import messages
-from django.db import transaction
-from django.db.models import Count, Exists, OuterRef
-from django.http import Http404, HttpResponse
+from django.db import IntegrityError, transaction
+from django.db.models import BooleanField, Case, Count, Exists, OuterRef, Q, Value, When
+from django.http import Http404, JsonResponse, StreamingHttpResponse
 from django.shortcuts import redirect, get_object_or_404
 from django.urls import reverse
 from django.utils.decorators import method_decorator
@@ -14,6 +14,7 @@ from django.utils.functional import cached_property
 from django.utils.translation import gettext_lazy as _, pgettext_lazy
 from django.views import View
 from django.views.decorators.clickjacking import xframe_options_exempt
+from django.views.decorators.gzip import gzip_page
 from django.views.generic import ListView, TemplateView, FormView
 from django_scopes import scopes_disabled
 
@@ -21,7 +22,7 @@ from pretix.helpers.compat import CompatDeleteView
 from pretix_cliques.tasks import run_raffle, run_rejection
 
 from django.conf import settings
-from pretix.base.models import Order, SubEvent, OrderPosition, OrderRefund, Event
+from pretix.base.models import Order, SubEvent, OrderPosition, OrderRefund, Event, LogEntry
 from pretix.base.views.metrics import unauthed_response
 from pretix.base.views.tasks import AsyncAction
 from pretix.control.forms.widgets import Select2
@@ -32,7 +33,7 @@ from pretix.multidomain.urlreverse import eventreverse
 from pretix.presale.views import EventViewMixin
 from pretix.presale.views.order import OrderDetailMixin
 from .checkoutflow import CliqueCreateForm, CliqueJoinForm
-from .models import Clique, OrderClique, OrderRaffleOverride
+from .models import Clique, OrderClique, OrderRaffleOverride, subevent_ids_suspended
 
 
 class CliqueChangePasswordForm(forms.Form):
@@ -73,10 +74,15 @@ class OrderCliqueChange(EventViewMixin, OrderDetailMixin, TemplateView):
     def post(self, request, *args, **kwargs):
         self.request = request
 
+        # If the order is locked, e.g. by a running raffle, do not block the web worker until it is done
+        if not Order.objects.select_for_update(skip_locked=True).filter(pk=self.order.pk).values_list('pk', flat=True):
+            messages.error(request, _('Your order is currently being processed. Please try again in a moment.'))
+            return redirect(self.get_order_url())
+
         mode = request.POST.get("clique_mode")
         if mode == "leave":
-            try:
-                c = self.order.orderclique
+            c = self.orderclique
+            if c:
                 c.delete()
                 self.order.log_action("pretix_cliques.order.left", data={
                     'clique': c.pk
@@ -87,13 +93,11 @@ class OrderCliqueChange(EventViewMixin, OrderDetailMixin, TemplateView):
                                                  'order': self.order.code,
                                                  'secret': self.order.secret,
                                              }))
-            except OrderClique.DoesNotExist:
-                pass
 
         elif mode == "change":
             if self.change_form.is_valid():
-                try:
-                    c = self.order.orderclique
+                c = self.orderclique
+                if c:
                     if c.is_admin:
                         c.clique.password = self.change_form.cleaned_data['password']
                         c.clique.save()
@@ -102,8 +106,6 @@ class OrderCliqueChange(EventViewMixin, OrderDetailMixin, TemplateView):
                     })
                     messages.success(request, _('Okay, we changed the password. Make sure to tell your friends!'))
                     return redirect(self.get_order_url())
-                except OrderClique.DoesNotExist:
-                    pass
 
         elif mode == 'join':
             if self.join_form.is_valid():
@@ -120,20 +122,32 @@ class OrderCliqueChange(EventViewMixin, OrderDetailMixin, TemplateView):
 
         elif mode == 'create':
             if self.create_form.is_valid():
-                clique = Clique(event=self.request.event)
-                clique.name = self.create_form.cleaned_data['name']
-                clique.password = self.create_form.cleaned_data['password']
-                clique.save()
-                OrderClique.objects.create(
-                    clique=clique,
-                    order=self.order,
-                    is_admin=True
-                )
-                self.order.log_action("pretix_cliques.order.created", data={
-                    'clique': clique.pk
-                })
-                messages.success(request, _('Great, we saved your changes!'))
-                return redirect(self.get_order_url())
+                try:
+                    # Rely on the unique index instead of the form's check alone, someone else might
+                    # have created a clique with the same name in the meantime. get_or_create() would
+                    # silently make this order the administrator of the other clique.
+                    with transaction.atomic():
+                        clique = Clique.objects.create(
+                            event=self.request.event,
+                            name=self.create_form.cleaned_data['name'],
+                            password=self.create_form.cleaned_data['password'],
+                        )
+                except IntegrityError:
+                    self.create_form.add_error('name', forms.ValidationError(
+                        self.create_form.error_messages['duplicate_name'],
+                        code='duplicate_name'
+                    ))
+                else:
+                    OrderClique.objects.create(
+                        clique=clique,
+                        order=self.order,
+                        is_admin=True
+                    )
+                    self.order.log_action("pretix_cliques.order.created", data={
+                        'clique': clique.pk
+                    })
+                    messages.success(request, _('Great, we saved your changes!'))
+                    return redirect(self.get_order_url())
         elif mode == 'none':
             messages.success(request, _('Great, we saved your changes!'))
             return redirect(self.get_order_url())
@@ -141,6 +155,10 @@ class OrderCliqueChange(EventViewMixin, OrderDetailMixin, TemplateView):
         messages.error(self.request, _("We could not handle your input. See below for more information."))
         return self.get(request, *args, **kwargs)
 
+    @cached_property
+    def orderclique(self):
+        return OrderClique.objects.select_related('clique').filter(order=self.order).first()
+
     @cached_property
     def change_form(self):
         return CliqueChangePasswordForm(
@@ -171,24 +189,21 @@ class OrderCliqueChange(EventViewMixin, OrderDetailMixin, TemplateView):
     def get_context_data(self, **kwargs):
         ctx = super().get_context_data(**kwargs)
         ctx['order'] = self.order
-        ctx['join_form'] = self.join_form
-        ctx['create_form'] = self.create_form
-        ctx['change_form'] = self.change_form
 
-        try:
-            c = self.order.orderclique
+        # Only build the forms the template actually renders for the current membership
+        c = self.orderclique
+        if c:
             ctx['clique'] = c.clique
             ctx['is_admin'] = c.is_admin
-        except OrderClique.DoesNotExist:
+            if c.is_admin:
+                ctx['change_form'] = self.change_form
+        else:
             ctx['selected'] = self.request.POST.get("clique_mode", 'none')
+            ctx['join_form'] = self.join_form
+            ctx['create_form'] = self.create_form
 
         return ctx
 
-    def dispatch(self, request, *args, **kwargs):
-        self.request = request
-
-        return super().dispatch(request, *args, **kwargs)
-
 
 class ControlCliqueForm(forms.ModelForm):
     class Meta:
@@ -199,20 +214,36 @@ class ControlCliqueForm(forms.ModelForm):
         self.event = kwargs.pop('event')
         super().__init__(*args, **kwargs)
         self.fields['clique'].queryset = self.event.cliques.all()
+        # The Select2 widget only renders the selected clique and loads the others on demand, so the
+        # page does not contain an option for every clique of the event
+        self.fields['clique'].widget = Select2(
+            attrs={
+                'data-model-select2': 'generic',
+                'data-select2-url': reverse('plugins:pretix_cliques:event.cliques.select2', kwargs={
+                    'event': self.event.slug,
+                    'organizer': self.event.organizer.slug,
+                }),
+            }
+        )
+        self.fields['clique'].widget.choices = self.fields['clique'].choices
 
 
 class RaffleOverrideChange(OrderView):
     permission = 'can_change_orders'
 
     def post(self, request, *args, **kwargs):
-        mode = request.POST.get('mode')
-        if mode not in dict(OrderRaffleOverride.MODE_CHOICES):
+        try:
+            mode = int(request.POST.get('mode'))
+        except (TypeError, ValueError):
+            mode = None
+        if mode not in OrderRaffleOverride.Mode.values:
             mode = OrderRaffleOverride.MODE_NORMAL
-        OrderRaffleOverride.objects.update_or_create(
-            order=self.order,
-            defaults={
-                'mode': mode
-            }
+        # Single INSERT ... ON CONFLICT DO UPDATE instead of SELECT followed by UPDATE or INSERT
+        OrderRaffleOverride.objects.bulk_create(
+            [OrderRaffleOverride(order=self.order, mode=mode)],
+            update_conflicts=True,
+            unique_fields=['order'],
+            update_fields=['mode'],
         )
         self.order.log_action('pretix_cliques.chance.changed', data={
             'mode': mode
@@ -227,9 +258,8 @@ class ControlCliqueChange(OrderView):
 
     @cached_property
     def form(self):
-        try:
-            instance = self.order.orderclique
-        except OrderClique.DoesNotExist:
+        instance = OrderClique.objects.select_related('clique').filter(order=self.order).first()
+        if instance is None:
             instance = OrderClique(order=self.order)
         return ControlCliqueForm(
             data=self.request.POST if self.request.method == "POST" else None,
@@ -258,7 +288,63 @@ class CliqueList(EventPermissionRequiredMixin, ListView):
     paginate_by = 25
 
     def get_queryset(self):
-        return self.request.event.cliques.all()
+        return self.request.event.cliques.annotate(member_count=Count('ordercliques'))
+
+    def paginate_queryset(self, queryset, page_size):
+        # Keyset pagination on the (per-event unique) name, so deep pages do not need a large OFFSET
+        before = self.request.GET.get('before')
+        after = self.request.GET.get('after')
+        if before:
+            # Walk backwards from the first clique of the following page
+            cliques = list(queryset.filter(name__lt=before).order_by('-name')[:page_size + 1])
+            self.has_previous = len(cliques) > page_size
+            self.has_next = True
+            cliques = cliques[:page_size][::-1]
+        else:
+            if after:
+                queryset = queryset.filter(name__gt=after)
+            cliques = list(queryset.order_by('name')[:page_size + 1])
+            self.has_previous = bool(after)
+            self.has_next = len(cliques) > page_size
+            cliques = cliques[:page_size]
+        return None, None, cliques, self.has_previous or self.has_next
+
+    def get_context_data(self, **kwargs):
+        ctx = super().get_context_data(**kwargs)
+        if ctx['cliques']:
+            if self.has_next:
+                ctx['next_after'] = ctx['cliques'][-1].name
+            if self.has_previous:
+                ctx['previous_before'] = ctx['cliques'][0].name
+        return ctx
+
+
+class CliqueSelect2(EventPermissionRequiredMixin, View):
+    permission = 'can_change_orders'
+    page_size = 20
+
+    def get(self, request, *args, **kwargs):
+        query = request.GET.get('query', '')
+        try:
+            page = max(int(request.GET.get('page', '1')), 1)
+        except ValueError:
+            page = 1
+        offset = (page - 1) * self.page_size
+
+        qs = request.event.cliques.order_by('name')
+        if query:
+            qs = qs.filter(name__icontains=query)
+        # Fetch one additional row to find out whether there is another page, instead of counting
+        cliques = list(qs.values('pk', 'name')[offset:offset + self.page_size + 1])
+        return JsonResponse({
+            'results': [
+                {'id': c['pk'], 'text': c['name']}
+                for c in cliques[:self.page_size]
+            ],
+            'pagination': {
+                'more': len(cliques) > self.page_size,
+            }
+        })
 
 
 class CliqueForm(forms.ModelForm):
@@ -272,7 +358,7 @@ class CliqueForm(forms.ModelForm):
 
     def clean_name(self):
         name = self.cleaned_data.get('name')
-        if Clique.objects.filter(event=self.event, name=name).exclude(pk=self.instance.pk).exists():
+        if 'name' in self.changed_data and Clique.objects.filter(event=self.event, name=name).exclude(pk=self.instance.pk).exists():
             raise forms.ValidationError(
                 _('Duplicate clique name'),
                 code='duplicate_name'
@@ -290,7 +376,13 @@ class CliqueDetail(EventPermissionRequiredMixin, UpdateView):
         return self.request.event.cliques.all()
 
     def form_valid(self, form):
-        form.save()
+        try:
+            with transaction.atomic():
+                form.save()
+        except IntegrityError:
+            # The unique index on (event, name) caught a clique renamed concurrently
+            form.add_error('name', forms.ValidationError(_('Duplicate clique name'), code='duplicate_name'))
+            return self.form_invalid(form)
         form.instance.log_action("pretix_cliques.clique.changed", data=form.cleaned_data, user=self.request.user)
         messages.success(self.request, _('Great, we saved your changes!'))
         return redirect(reverse('plugins:pretix_cliques:event.cliques.list', kwargs={
@@ -300,7 +392,9 @@ class CliqueDetail(EventPermissionRequiredMixin, UpdateView):
 
     def get_context_data(self, **kwargs):
         ctx = super().get_context_data(**kwargs)
-        ctx['orders'] = self.object.ordercliques.select_related('order')
+        ctx['orders'] = self.object.ordercliques.select_related('order').only(
+            'id', 'clique', 'is_admin', 'order__code', 'order__email', 'order__status'
+        )
         return ctx
 
 
@@ -312,22 +406,22 @@ class CliqueDelete(EventPermissionRequiredMixin, CompatDeleteView):
     def get_queryset(self):
         return self.request.event.cliques.all()
 
-    def get_context_data(self, **kwargs):
-        ctx = super().get_context_data(**kwargs)
-        ctx['orders'] = self.object.ordercliques.select_related('order')
-        return ctx
-
     @transaction.atomic
     def delete(self, request, *args, **kwargs):
         o = self.object = self.get_object()
         o.log_action("pretix_cliques.clique.deleted", data={
             "name": o.name
         }, user=request.user)
-        for oc in self.object.ordercliques.select_related('order'):
-            oc.order.log_action("pretix_cliques.order.deleted", data={
+        logs = []
+        for oc in self.object.ordercliques.select_related('order').only('id', 'clique', 'order__id', 'order__event'):
+            oc.order.event = request.event
+            logs.append(oc.order.log_action("pretix_cliques.order.deleted", data={
                 'clique': o.pk
-            }, user=request.user)
-            oc.delete()
+            }, user=request.user, save=False))
+        LogEntry.objects.bulk_create(logs, batch_size=500)
+        # The clique is deleted right away, recomputing its subevents once per membership would be wasted
+        with subevent_ids_suspended():
+            self.object.ordercliques.all().delete()
         o.delete()
         messages.success(self.request, _('The clique has been deleted.'))
         return redirect(reverse('plugins:pretix_cliques:event.cliques.list', kwargs={
@@ -336,6 +430,20 @@ class CliqueDelete(EventPermissionRequiredMixin, CompatDeleteView):
         }))
 
 
+@lru_cache(maxsize=256)
+def _subevent_widget_attrs(organizer_slug, event_slug):
+    # Widgets copy their attrs, so sharing the cached dict is safe
+    return {
+        'data-inverse-dependency': '#id_all_subevents',
+        'data-model-select2': 'event',
+        'data-select2-url': reverse('control:event.subevents.select2', kwargs={
+            'event': event_slug,
+            'organizer': organizer_slug,
+        }),
+        'data-placeholder': pgettext_lazy('subevent', 'All dates')
+    }
+
+
 class RaffleForm(forms.Form):
     subevent = forms.ModelChoiceField(
         SubEvent.objects.none(),
@@ -362,15 +470,7 @@ class RaffleForm(forms.Form):
         if self.event.has_subevents:
             self.fields['subevent'].queryset = self.event.subevents.all()
             self.fields['subevent'].widget = Select2(
-                attrs={
-                    'data-inverse-dependency': '#id_all_subevents',
-                    'data-model-select2': 'event',
-                    'data-select2-url': reverse('control:event.subevents.select2', kwargs={
-                        'event': self.event.slug,
-                        'organizer': self.event.organizer.slug,
-                    }),
-                    'data-placeholder': pgettext_lazy('subevent', 'All dates')
-                }
+                attrs=_subevent_widget_attrs(self.event.organizer.slug, self.event.slug)
             )
             self.fields['subevent'].widget.choices = self.fields['subevent'].choices
         else:
@@ -391,15 +491,7 @@ class RejectForm(forms.Form):
         if self.event.has_subevents:
             self.fields['subevent'].queryset = self.event.subevents.all()
             self.fields['subevent'].widget = Select2(
-                attrs={
-                    'data-inverse-dependency': '#id_all_subevents',
-                    'data-model-select2': 'event',
-                    'data-select2-url': reverse('control:event.subevents.select2', kwargs={
-                        'event': self.event.slug,
-                        'organizer': self.event.organizer.slug,
-                    }),
-                    'data-placeholder': pgettext_lazy('subevent', 'All dates')
-                }
+                attrs=_subevent_widget_attrs(self.event.organizer.slug, self.event.slug)
             )
             self.fields['subevent'].widget.choices = self.fields['subevent'].choices
         else:
@@ -435,17 +527,18 @@ class RaffleView(EventPermissionRequiredMixin, AsyncAction, FormView):
     def get_success_message(self, value):
         return _('The raffle has been performed, {count} orders have been approved.').format(count=value)
 
-    def get_success_url(self, value):
+    @cached_property
+    def raffle_url(self):
         return reverse('plugins:pretix_cliques:event.raffle', kwargs={
             'organizer': self.request.organizer.slug,
             'event': self.request.event.slug,
         })
 
+    def get_success_url(self, value):
+        return self.raffle_url
+
     def get_error_url(self):
-        return reverse('plugins:pretix_cliques:event.raffle', kwargs={
-            'organizer': self.request.organizer.slug,
-            'event': self.request.event.slug,
-        })
+        return self.raffle_url
 
     def get_error_message(self, exception):
         if isinstance(exception, str):
@@ -484,17 +577,18 @@ class RaffleRejectView(EventPermissionRequiredMixin, AsyncAction, FormView):
     def get_success_message(self, value):
         return _('{count} orders have been rejected.').format(count=value)
 
-    def get_success_url(self, value):
+    @cached_property
+    def reject_url(self):
         return reverse('plugins:pretix_cliques:event.raffle.reject', kwargs={
             'organizer': self.request.organizer.slug,
             'event': self.request.event.slug,
         })
 
+    def get_success_url(self, value):
+        return self.reject_url
+
     def get_error_url(self):
-        return reverse('plugins:pretix_cliques:event.raffle.reject', kwargs={
-            'organizer': self.request.organizer.slug,
-            'event': self.request.event.slug,
-        })
+        return self.reject_url
 
     def get_error_message(self, exception):
         if isinstance(exception, str):
@@ -506,63 +600,67 @@ class RaffleRejectView(EventPermissionRequiredMixin, AsyncAction, FormView):
         return super().form_invalid(form)
 
 
+TICKET_STATS = (
+    {
+        'id': 'tickets_total',
+        'label': _('All tickets, total'),
+        'q': Q(order__status=Order.STATUS_PENDING, order__require_approval=True),
+        'qs_cliq': True
+    },
+    {
+        'id': 'tickets_registered',
+        'label': _('Tickets registered for raffle'),
+        'q': Q(order__status=Order.STATUS_PENDING, order__require_approval=True),
+        'qs_cliq': True
+    },
+    {
+        'id': 'tickets_approved',
+        'label': _('Tickets in approved orders (regardless of payment status)'),
+        'q': Q(order__require_approval=False),
+        'qs_cliq': True
+    },
+    {
+        'id': 'tickets_paid',
+        'label': _('Tickets in paid orders'),
+        'q': Q(order__require_approval=False, order__status=Order.STATUS_PAID),
+    },
+    {
+        'id': 'tickets_pending',
+        'label': _('Tickets in pending orders'),
+        'q': Q(order__require_approval=False, order__status=Order.STATUS_PENDING),
+    },
+    {
+        'id': 'tickets_canceled',
+        'label': _('Tickets in canceled orders (except the ones not chosen in raffle)'),
+        'q': Q(order__require_approval=False, order__status=Order.STATUS_CANCELED),
+    },
+    {
+        'id': 'tickets_canceled_refunded',
+        'label': _('Tickets in canceled and at least partially refunded orders'),
+        'q': Q(price__gt=0, order__status=Order.STATUS_CANCELED, has_refund=True),
+    },
+    {
+        'id': 'tickets_denied',
+        'label': _('Tickets denied (not chosen in raffle)'),
+        'q': Q(order__require_approval=True, order__status=Order.STATUS_CANCELED),
+        'qs_cliq': True
+    },
+)
+
+
 class StatsMixin:
-    def get_ticket_stats(self, event):
-        qs = OrderPosition.objects.filter(
+    def get_ticket_stats_base(self, event):
+        return OrderPosition.objects.filter(
             order__event=event,
         ).annotate(
-            has_clique=Exists(OrderClique.objects.filter(order_id=OuterRef('order_id')))
+            # OrderClique.order is a OneToOneField, so this is a plain LEFT JOIN without duplicated rows
+            has_clique=Case(
+                When(order__orderclique__isnull=False, then=Value(True)),
+                default=Value(False),
+                output_field=BooleanField(),
+            ),
+            has_refund=Exists(OrderRefund.objects.filter(order_id=OuterRef('order_id'), state__in=[OrderRefund.REFUND_STATE_DONE])),
         )
-        return [
-            {
-                'id': 'tickets_total',
-                'label': _('All tickets, total'),
-                'qs': qs.filter(order__status=Order.STATUS_PENDING, order__require_approval=True),
-                'qs_cliq': True
-            },
-            {
-                'id': 'tickets_registered',
-                'label': _('Tickets registered for raffle'),
-                'qs': qs.filter(order__status=Order.STATUS_PENDING, order__require_approval=True),
-                'qs_cliq': True
-            },
-            {
-                'id': 'tickets_approved',
-                'label': _('Tickets in approved orders (regardless of payment status)'),
-                'qs': qs.filter(order__require_approval=False),
-                'qs_cliq': True
-            },
-            {
-                'id': 'tickets_paid',
-                'label': _('Tickets in paid orders'),
-                'qs': qs.filter(order__require_approval=False, order__status=Order.STATUS_PAID),
-            },
-            {
-                'id': 'tickets_pending',
-                'label': _('Tickets in pending orders'),
-                'qs': qs.filter(order__require_approval=False, order__status=Order.STATUS_PENDING),
-            },
-            {
-                'id': 'tickets_canceled',
-                'label': _('Tickets in canceled orders (except the ones not chosen in raffle)'),
-                'qs': qs.filter(order__require_approval=False, order__status=Order.STATUS_CANCELED),
-            },
-            {
-                'id': 'tickets_canceled_refunded',
-                'label': _('Tickets in canceled and at least partially refunded orders'),
-                'qs': qs.annotate(
-                    has_refund=Exists(OrderRefund.objects.filter(order_id=OuterRef('order_id'), state__in=[OrderRefund.REFUND_STATE_DONE]))
-                ).filter(
-                    price__gt=0, order__status=Order.STATUS_CANCELED, has_refund=True
-                ),
-            },
-            {
-                'id': 'tickets_denied',
-                'label': _('Tickets denied (not chosen in raffle)'),
-                'qs': qs.filter(order__require_approval=True, order__status=Order.STATUS_CANCELED),
-                'qs_cliq': True
-            },
-        ]
 
 
 class StatsView(StatsMixin, EventPermissionRequiredMixin, TemplateView):
@@ -570,56 +668,57 @@ class StatsView(StatsMixin, EventPermissionRequiredMixin, TemplateView):
     permission = 'can_view_orders'
 
     def get_context_data(self, **kwargs):
-
-        def qs_by_item(qs):
-            d = defaultdict(lambda: defaultdict(lambda: 0))
-            for r in qs:
-                d[r['item']][r['subevent']] = r['c']
-            return d
-
-        def qs_by_clique(qs):
-            d = defaultdict(lambda: defaultdict(lambda: 0))
-            for r in qs:
-                d[r['has_clique']][r['subevent']] = r['c']
-            return d
-
-        def qs_by_unique_clique(qs):
-            d = defaultdict(lambda: defaultdict(lambda: 0))
-            for r in qs:
-                d[r['has_clique']][r['subevent']] = r['cc']
-            return d
-
-        def qs_by_subevent(qs):
-            d = defaultdict(lambda: defaultdict(lambda: 0))
-            for r in qs:
-                d[r['subevent']][r['item']] = r['c']
-            return d
-
         ctx = super().get_context_data()
         ctx['subevents'] = self.request.event.subevents.all()
         ctx['items'] = self.request.event.items.all()
-        ctx['ticket_stats'] = []
-        for d in self.get_ticket_stats(self.request.event):
-            qs = list(d['qs'].order_by().values('subevent', 'item').annotate(c=Count('*')))
-            if d.get('qs_cliq'):
-                qsc = list(d['qs'].order_by().values('subevent', 'has_clique').annotate(c=Count('*'), cc=Count('order__orderclique__clique', distinct=True)))
-                c1 = qs_by_clique(qsc)
-                c2 = qs_by_unique_clique(qsc)
-            else:
-                c1 = c2 = None
-
-            ctx['ticket_stats'].append((
+
+        base = self.get_ticket_stats_base(self.request.event).order_by()
+
+        # All metrics are computed with conditional aggregates in one query. Unique cliques need a
+        # second one, since distinct counts per item can not be added up to distinct counts per date.
+        rows = base.values('subevent', 'item', 'has_clique').annotate(**{
+            d['id']: Count('pk', filter=d['q']) for d in TICKET_STATS
+        })
+        clique_rows = base.filter(has_clique=True).values('subevent').annotate(**{
+            d['id']: Count('order__orderclique__clique', distinct=True, filter=d['q']) for d in TICKET_STATS if d.get('qs_cliq')
+        })
+
+        # Plain dicts filled in a single pass over the rows, the template falls back to 0 for missing keys
+        by_item = {d['id']: {} for d in TICKET_STATS}
+        by_subevent = {d['id']: {} for d in TICKET_STATS}
+        by_cliq = {d['id']: {} for d in TICKET_STATS if d.get('qs_cliq')}
+        cliques = {d['id']: {True: {}} for d in TICKET_STATS if d.get('qs_cliq')}
+        for r in rows:
+            item, subevent = r['item'], r['subevent']
+            for stat_id in by_item:
+                c = r[stat_id]
+                cell = by_item[stat_id].setdefault(item, {})
+                cell[subevent] = cell.get(subevent, 0) + c
+                cell = by_subevent[stat_id].setdefault(subevent, {})
+                cell[item] = cell.get(item, 0) + c
+                if stat_id in by_cliq:
+                    cell = by_cliq[stat_id].setdefault(r['has_clique'], {})
+                    cell[subevent] = cell.get(subevent, 0) + c
+        for r in clique_rows:
+            for stat_id in cliques:
+                cliques[stat_id][True][r['subevent']] = r[stat_id]
+
+        ctx['ticket_stats'] = [
+            (
                 d['label'],
-                qs_by_item(qs),
-                qs_by_subevent(qs),
-                c1,
-                c2
-            ))
+                by_item[d['id']],
+                by_subevent[d['id']],
+                by_cliq.get(d['id']),
+                cliques.get(d['id']),
+            )
+            for d in TICKET_STATS
+        ]
         return ctx
 
 
 class MetricsView(StatsMixin, View):
 
+    @method_decorator(gzip_page)
     @scopes_disabled()
     def get(self, request, organizer, event):
         event = get_object_or_404(Event, slug=event, organizer__slug=organizer)
@@ -630,36 +729,44 @@ class MetricsView(StatsMixin, View):
         if "Authorization" not in request.headers:
             return unauthed_response()
 
-        method, credentials = request.headers["Authorization"].split(" ", 1)
+        method, __, credentials = request.headers["Authorization"].partition(" ")
         if method.lower() != "basic":
             return unauthed_response()
 
-        user, passphrase = base64.b64decode(credentials.strip()).decode().split(":", 1)
-
-        if not hmac.compare_digest(user, settings.METRICS_USER):
+        try:
+            # binascii.Error is a subclass of ValueError
+            provided = base64.b64decode(credentials.strip(), validate=True)
+        except ValueError:
             return unauthed_response()
-        if not hmac.compare_digest(passphrase, settings.METRICS_PASSPHRASE):
+
+        # Compare user and passphrase at once, so the response time tells nothing about which one was wrong
+        expected = "{}:{}".format(settings.METRICS_USER, settings.METRICS_PASSPHRASE).encode()
+        if not hmac.compare_digest(provided, expected):
             return unauthed_response()
 
         # ok, the request passed the authentication-barrier, let's hand out the metrics:
-        m = defaultdict(dict)
-        for d in self.get_ticket_stats(event):
-            if d.get('qs_cliq'):
-                qs = d['qs'].order_by().values('subevent', 'item', 'has_clique').annotate(c=Count('*'), cc=Count('order__orderclique__clique', distinct=True))
-                for r in qs:
-                    m[d['id']]['{item="%s",subevent="%s",hasclique="%s"}' % (r['item'], r['subevent'], r['has_clique'])] = r['c']
-                    if r['cc']:
-                        m[d['id'] + '_unique_cliques']['{item="%s",subevent="%s"}' % (r['item'], r['subevent'])] = r['cc']
-            else:
-                qs = d['qs'].order_by().values('subevent', 'item').annotate(c=Count('*'))
-                for r in qs:
-                    m[d['id']]['{item="%s",subevent="%s"}' % (r['item'], r['subevent'])] = r['c']
-
-        output = []
-        for metric, sub in m.items():
-            for label, value in sub.items():
-                output.append("{}{} {}".format(metric, label, str(value)))
-
-        content = "\n".join(output) + "\n"
-
-        return HttpResponse(content)
+        return StreamingHttpResponse(self._metric_lines(event), content_type='text/plain; version=0.0.4')
+
+    def _metric_lines(self, event):
+        # The generator is consumed after get() returned, so it needs its own scope handling
+        with scopes_disabled():
+            base = self.get_ticket_stats_base(event).order_by()
+            for d in TICKET_STATS:
+                metric = d['id']
+                if d.get('qs_cliq'):
+                    qs = base.filter(d['q']).values('subevent', 'item', 'has_clique').annotate(
+                        c=Count('*'),
+                        cc=Count('order__orderclique__clique', distinct=True),
+                    )
+                    # All samples of a metric need to be grouped together, so the unique clique
+                    # samples are held back until the main metric is complete
+                    unique_cliques = []
+                    for r in qs.iterator(chunk_size=5000):
+                        yield f'{metric}{{item="{r["item"]}",subevent="{r["subevent"]}",hasclique="{r["has_clique"]}"}} {r["c"]}\n'
+                        if r['cc']:
+                            unique_cliques.append(f'{metric}_unique_cliques{{item="{r["item"]}",subevent="{r["subevent"]}"}} {r["cc"]}\n')
+                    yield from unique_cliques
+                else:
+                    qs = base.filter(d['q']).values('subevent', 'item').annotate(c=Count('*'))
+                    for r in qs.iterator(chunk_size=5000):
+                        yield f'{metric}{{item="{r["item"]}",subevent="{r["subevent"]}"}} {r["c"]}\n'